@@ -3,6 +3,14 @@
 Incident Response Plan for FlipFile
 """
 
+import asyncio
+from datetime import datetime, timezone
+from src.utils.log_batcher import LogBatcher
+
+# Shared across instances so all incidents go through one background writer
+# (await incident_log.stop() from the app's shutdown hook)
+incident_log = LogBatcher('logs/incidents.log')
+
 class IncidentResponse:
     """Handle security incidents"""
     
@@ -23,14 +31,16 @@ class IncidentResponse:
     
     async def handle_incident(self, incident_type, details):
         """Handle security incident"""
-        # Log incident
-        await self.log_incident(incident_type, details)
+        severity = self.calculate_severity(incident_type, details)
         
-        # Alert response team
-        await self.alert_response_team(incident_type, details)
+        # Log incident
+        await self.log_incident(incident_type, details, severity)
         
-        # Take immediate action
-        await self.take_immediate_action(incident_type, details)
+        # Alert response team and take immediate action (independent, run concurrently)
+        await asyncio.gather(
+            self.alert_response_team(incident_type, details, severity),
+            self.take_immediate_action(incident_type, details)
+        )
         
         # Investigate
         await self.investigate(incident_type, details)
@@ -41,24 +51,24 @@ class IncidentResponse:
         # Document lessons learned
         await self.document_lessons_learned(incident_type, details)
     
-    async def log_incident(self, incident_type, details):
+    async def log_incident(self, incident_type, details, severity=None):
         """Log security incident"""
         log_entry = {
-            'timestamp': datetime.utcnow(),
+            'timestamp': datetime.now(timezone.utc),
             'type': incident_type,
             'details': details,
-            'severity': self.calculate_severity(incident_type, details)
+            'severity': severity or self.calculate_severity(incident_type, details)
         }
         
-        # Log to database
-        await self._log_to_database(log_entry)
-        
-        # Log to file
-        await self._log_to_file(log_entry)
+        # Log to database and file (independent sinks)
+        await asyncio.gather(
+            self._log_to_database(log_entry),
+            self._log_to_file(log_entry)
+        )
     
-    async def alert_response_team(self, incident_type, details):
+    async def alert_response_team(self, incident_type, details, severity=None):
         """Alert response team"""
-        severity = self.calculate_severity(incident_type, details)
+        severity = severity or self.calculate_severity(incident_type, details)
         
         if severity in ['high', 'critical']:
             # Send immediate alerts
@@ -137,11 +147,9 @@ class IncidentResponse:
     
     async def _log_to_file(self, log_entry):
         """Log incident to file"""
-        log_file = 'logs/incidents.log'
         log_line = f"{log_entry['timestamp']} - {log_entry['type']} - {log_entry['severity']}\n"
         
-        async with aiofiles.open(log_file, 'a') as f:
-            await f.write(log_line)
+        incident_log.write(log_line)
     
     async def _send_alerts(self, incident_type, details, severity):
         """Send alerts to response team"""
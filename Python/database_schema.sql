@@ -41,6 +41,7 @@ CREATE TABLE files (
     mime_type VARCHAR(100) NOT NULL,
     size_bytes BIGINT NOT NULL,
     hash_sha256 VARCHAR(64) NOT NULL,
+    quick_hash VARCHAR(32) NOT NULL, -- BLAKE2b of size + first 4KB, duplicate pre-check
     encryption_key_encrypted TEXT NOT NULL, -- Encrypted with master key
     iv TEXT NOT NULL, -- Initialization vector for AES
     uploaded_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
@@ -61,6 +62,7 @@ CREATE TABLE files (
     -- Indexes
     INDEX idx_files_user_id ON files(user_id),
     INDEX idx_files_hash ON files(hash_sha256),
+    INDEX idx_files_quick_hash ON files(quick_hash),
     INDEX idx_files_expires_at ON files(expires_at),
     INDEX idx_files_uploaded_at ON files(uploaded_at DESC),
     INDEX idx_files_virus_scan_status ON files(virus_scan_status)
@@ -6,24 +6,142 @@ import os
 import uuid
 import hashlib
 import tempfile
-from typing import Optional, BinaryIO, Dict, Any
-from datetime import datetime, timedelta
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from typing import Optional, BinaryIO, Callable, Dict, Any, Tuple
+from datetime import datetime, timedelta, timezone
 from fastapi import UploadFile, HTTPException, status
 import magic
-from cryptography.fernet import Fernet
+import ahocorasick
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import InvalidUnwrap, aes_key_unwrap, aes_key_wrap
 from src.core.config import settings
 from src.utils.file_utils import FileUtils
 from src.utils.security_utils import SecurityUtils
 import aiofiles
 import asyncio
 
+# Encrypted file layout: [12-byte GCM nonce][ciphertext][16-byte GCM tag]
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Leading bytes of JPEG, PNG and GIF (87a/89a) files
+IMAGE_MAGIC = (b'\xff\xd8', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+
+# Expected MIME type for each allowed file extension
+EXTENSION_MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'svg': 'image/svg+xml',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ppt': 'application/vnd.ms-powerpoint',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+}
+
+# Bytes of the first chunk handed to the header-based content validators
+HEADER_SIZE = 4096
+
+# Per-file AES-256 data key
+DATA_KEY_SIZE = 32
+
+# Basic malware pattern detection
+SUSPICIOUS_PATTERNS = (
+    b'eval(',
+    b'base64_decode(',
+    b'shell_exec(',
+    b'passthru(',
+    b'system(',
+    b'exec(',
+    b'<script>',
+    b'javascript:'
+)
+# Bytes carried over between streamed chunks so no pattern straddles a boundary
+SCAN_OVERLAP = max(len(pattern) for pattern in SUSPICIOUS_PATTERNS) - 1
+
+# Compile all patterns into a single Aho-Corasick automaton so each chunk is
+# walked once in C. Keys are latin-1 decoded so bytes map 1:1 onto characters.
+MALWARE_AUTOMATON = ahocorasick.Automaton()
+for _pattern in SUSPICIOUS_PATTERNS:
+    MALWARE_AUTOMATON.add_word(_pattern.decode('latin-1'), _pattern)
+MALWARE_AUTOMATON.make_automaton()
+
+# The pattern scan holds the GIL (~8-9 ms per MB), so it runs in worker
+# processes while the upload thread keeps hashing and encrypting; shipping a
+# 1MB chunk to a worker costs ~2 ms. Bounds in-flight chunks per upload.
+MAX_PENDING_SCANS = 4
+
+_cpu_pool: Optional[ProcessPoolExecutor] = None
+_cpu_pool_lock = threading.Lock()
+
+def _new_cpu_pool() -> ProcessPoolExecutor:
+    # Workers come from a single-threaded forkserver, never forked from the
+    # (multi-threaded) app process. Each app process (uvicorn worker) has its
+    # own pool, so MALWARE_SCAN_WORKERS is per app process.
+    return ProcessPoolExecutor(
+        max_workers=settings.MALWARE_SCAN_WORKERS,
+        mp_context=multiprocessing.get_context('forkserver')
+    )
+
+def start_cpu_pool():
+    """Start the malware scan process pool (call on app startup)"""
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = _new_cpu_pool()
+
+def shutdown_cpu_pool():
+    """Stop the malware scan process pool (call on app shutdown)"""
+    global _cpu_pool
+    with _cpu_pool_lock:
+        pool, _cpu_pool = _cpu_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+def _replace_broken_cpu_pool(broken: ProcessPoolExecutor):
+    """Swap in a fresh pool after a worker died, so later uploads can use it again"""
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is broken:
+            _cpu_pool = _new_cpu_pool()
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _contains_suspicious_pattern(content: bytes) -> bool:
+    """Walk content through the malware automaton (runs in a worker process)"""
+    for _ in MALWARE_AUTOMATON.iter(content.decode('latin-1')):
+        return True
+    return False
+
 class FileService:
     """Secure file handling service"""
     
     def __init__(self):
         self.temp_dir = tempfile.gettempdir()
+        self.encrypted_dir = f"{self.temp_dir}/encrypted"
         self.encryption_key = settings.ENCRYPTION_KEY.encode()
-        self.cipher = Fernet(self.encryption_key)
+        
+        # Derive the key-encryption key that wraps each file's data key.
+        # Deleting a file's metadata discards its wrapped data key, which
+        # makes the ciphertext unrecoverable (crypto-shredding).
+        self.key_encryption_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'flipfile-key-wrapping'
+        ).derive(self.encryption_key)
         
         # Allowed file types with MIME validation
         self.allowed_types = {
@@ -38,182 +156,202 @@ class FileService:
                 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
             ]
         }
+        self.allowed_mime_types = frozenset(chain.from_iterable(self.allowed_types.values()))
     
-    async def validate_and_save(self, file: UploadFile, user_id: Optional[str] = None) -> Dict[str, Any]:
-        """Validate and securely save uploaded file"""
-        
-        # 1. Validate file size
-        await self._validate_file_size(file)
-        
-        # 2. Validate file type
-        await self._validate_file_type(file)
+    async def startup(self):
+        """Start background resources (call from the app's startup hook)"""
+        # Pre-create the shard directories so uploads never mkdir
+        await asyncio.to_thread(self._ensure_shard_tree)
+        start_cpu_pool()
+    
+    async def shutdown(self):
+        """Release background resources (call from the app's shutdown hook)"""
+        await asyncio.to_thread(shutdown_cpu_pool)
+    
+    def _ensure_shard_tree(self):
+        """Create the 256x256 two-level shard tree once per deploy"""
+        sentinel = f"{self.encrypted_dir}/.shards-ready"
+        if os.path.exists(sentinel):
+            return
         
-        # 3. Scan for malware
-        await self._scan_for_malware(file)
+        for a in range(256):
+            for b in range(256):
+                os.makedirs(f"{self.encrypted_dir}/{a:02x}/{b:02x}", exist_ok=True)
         
-        # 4. Validate file content
-        await self._validate_file_content(file)
+        open(sentinel, 'w').close()
+    
+    def _create_in_shard(self, create: Callable[[str], Any], file_path: str) -> Any:
+        """Run create(file_path), recreating its shard directory if it was removed (blocking)"""
+        try:
+            return create(file_path)
+        except FileNotFoundError:
+            # Shard removed after setup (tmp cleaner, manual cleanup)
+            shard_dir = os.path.dirname(file_path)
+            if os.path.isdir(shard_dir):
+                raise
+            os.makedirs(shard_dir, exist_ok=True)
+            return create(file_path)
+    
+    async def validate_and_save(self, file: UploadFile, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """Validate and securely save uploaded file"""
         
-        # 5. Generate secure filename
+        # 1. Generate secure filename
         secure_filename = self._generate_secure_filename(file.filename)
         
-        # 6. Create unique file ID
+        # 2. Create unique file ID
         file_id = str(uuid.uuid4())
         
-        # 7. Calculate file hash (for deduplication and verification)
-        file_hash = await self._calculate_file_hash(file)
+        # 3. Fingerprint size + header so most uploads skip the duplicate lookup
+        quick_hash = await asyncio.to_thread(self._calculate_quick_hash, file)
         
-        # 8. Encrypt file content
-        encrypted_path = await self._encrypt_and_save(file, file_id)
+        # 4. Validate size, type and content, scan, hash and encrypt in a single pass
+        #    (or link an identical stored file instead of encrypting it again)
+        encrypted_path, file_hash, file_size, wrapped_key = await self._encrypt_and_save(file, file_id, quick_hash)
         
-        # 9. Store metadata
+        # 5. Store metadata
+        uploaded_at = datetime.now(timezone.utc)
+        expires_at = uploaded_at + timedelta(minutes=settings.FILE_RETENTION_MINUTES)
         metadata = {
             'id': file_id,
             'original_name': file.filename,
             'secure_name': secure_filename,
             'mime_type': file.content_type,
-            'size': file.size,
+            'size': file_size,
             'hash': file_hash,
-            'uploaded_at': datetime.utcnow(),
-            'expires_at': datetime.utcnow() + timedelta(minutes=settings.FILE_RETENTION_MINUTES),
+            'quick_hash': quick_hash,
+            'uploaded_at': uploaded_at,
+            'expires_at': expires_at,
             'user_id': user_id,
             'encrypted_path': encrypted_path,
+            'encryption_key_encrypted': wrapped_key,
             'is_encrypted': True,
             'is_compressed': False,
             'virus_scan_status': 'clean'
         }
         
-        # 10. Store metadata in database (simplified)
+        # 6. Store metadata in database (simplified)
         await self._store_metadata(metadata)
         
         return metadata
     
-    async def _validate_file_size(self, file: UploadFile):
-        """Validate file size"""
-        # Seek to end to get actual size
-        await file.seek(0, 2)
-        file_size = await file.tell()
-        await file.seek(0)
-        
+    def _validate_file_size(self, file_size: int):
+        """Validate file size (called with the running byte count while streaming)"""
         if file_size > settings.MAX_FILE_SIZE:
             raise HTTPException(
                 status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
                 detail=f"File size exceeds maximum limit of {settings.MAX_FILE_SIZE / 1024 / 1024}MB"
             )
     
-    async def _validate_file_type(self, file: UploadFile):
+    def _validate_file_type(self, file: UploadFile, header: bytes):
         """Validate file type using MIME and extension"""
-        # Get actual MIME type using magic
-        content = await file.read(2048)  # Read first 2KB
-        await file.seek(0)
-        
-        mime = magic.from_buffer(content, mime=True)
+        # Get actual MIME type using magic on the first 2KB
+        mime = magic.from_buffer(header[:2048], mime=True)
         
         # Check if MIME type is allowed
-        all_allowed = sum(self.allowed_types.values(), [])
-        if mime not in all_allowed:
+        if mime not in self.allowed_mime_types:
             raise HTTPException(
                 status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
                 detail=f"File type {mime} is not supported"
             )
         
         # Validate extension matches MIME type
-        extension = file.filename.split('.')[-1].lower()
+        extension = os.path.splitext(file.filename)[1][1:].lower()
         if not self._is_valid_extension(extension, mime):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="File extension does not match content type"
             )
     
-    async def _scan_for_malware(self, file: UploadFile):
-        """Scan file for malware using ClamAV or VirusTotal"""
+    def _scan_for_malware(self, chunk: bytes, tail: bytes = b'') -> Tuple[Future, bytes, bytes]:
+        """Submit a streamed chunk for malware scanning, returning the pending scan, the scanned content and the tail to carry into the next call"""
         # For now, implement basic checks
-        content = await file.read()
-        await file.seek(0)
-        
-        # Basic malware pattern detection
-        suspicious_patterns = [
-            b'eval(',
-            b'base64_decode(',
-            b'shell_exec(',
-            b'passthru(',
-            b'system(',
-            b'exec(',
-            b'<script>',
-            b'javascript:'
-        ]
-        
-        for pattern in suspicious_patterns:
-            if pattern in content:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="File contains suspicious content"
-                )
+        content = tail + chunk
+        scan = None
+        pool = _cpu_pool
+        if pool is not None:
+            try:
+                scan = pool.submit(_contains_suspicious_pattern, content)
+            except BrokenProcessPool:
+                # A worker died (OOM kill, crash): replace the pool for later chunks
+                _replace_broken_cpu_pool(pool)
+            except RuntimeError:
+                # Pool shut down (app shutdown in progress)
+                pass
+        
+        # Pool not running: scan in this thread
+        if scan is None:
+            scan = Future()
+            scan.set_result(_contains_suspicious_pattern(content))
         
         # In production, integrate with:
         # 1. ClamAV (local)
         # 2. VirusTotal API
         # 3. Custom ML models
+        
+        return scan, content, content[-SCAN_OVERLAP:]
+    
+    def _check_malware_scan(self, scan: Future, content: bytes):
+        """Reject the upload if a submitted scan found a suspicious pattern"""
+        try:
+            found = scan.result()
+        except (BrokenProcessPool, CancelledError):
+            # The worker died mid-scan (the next submit replaces the pool) or
+            # the pool was shut down with the scan pending: rescan here
+            found = _contains_suspicious_pattern(content)
+        
+        if found:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="File contains suspicious content"
+            )
     
-    async def _validate_file_content(self, file: UploadFile):
-        """Validate file content structure"""
+    def _validate_file_content(self, file: UploadFile, header: bytes):
+        """Validate file content structure from the first bytes of the upload"""
         # PDF validation
         if file.content_type == 'application/pdf':
-            await self._validate_pdf(file)
+            self._validate_pdf(header)
         
         # Image validation
         elif file.content_type.startswith('image/'):
-            await self._validate_image(file)
+            self._validate_image(header)
         
         # Office document validation
         elif 'office' in file.content_type or 'document' in file.content_type:
-            await self._validate_office_document(file)
+            self._validate_office_document(header)
     
-    async def _validate_pdf(self, file: UploadFile):
+    def _validate_pdf(self, header: bytes):
         """Validate PDF structure"""
-        content = await file.read(1024)
-        await file.seek(0)
-        
         # Check PDF header
-        if not content.startswith(b'%PDF'):
+        if not header.startswith(b'%PDF'):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid PDF file"
             )
         
         # Check for embedded JavaScript (security risk)
-        if b'/JavaScript' in content or b'/JS' in content:
+        if b'/JavaScript' in header or b'/JS' in header:
             raise HTTPException(
                 status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                 detail="PDF contains JavaScript which is not allowed for security reasons"
             )
     
-    async def _validate_image(self, file: UploadFile):
+    def _validate_image(self, header: bytes):
         """Validate image file"""
-        # Check for valid image headers
-        content = await file.read(12)
-        await file.seek(0)
-        
-        # JPEG
-        if content.startswith(b'\xff\xd8'):
-            return True
-        
-        # PNG
-        elif content.startswith(b'\x89PNG\r\n\x1a\n'):
-            return True
-        
-        # GIF
-        elif content.startswith(b'GIF87a') or content.startswith(b'GIF89a'):
-            return True
-        
-        # SVG (text-based)
-        elif b'<svg' in content[:100]:
-            return True
-        
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid image file"
-        )
+        # Check for valid binary image headers, or an SVG (text-based) tag
+        if not (header.startswith(IMAGE_MAGIC) or b'<svg' in header[:100]):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid image file"
+            )
+    
+    def _validate_office_document(self, header: bytes):
+        """Validate Office document container"""
+        # Legacy formats are OLE2 compound files, OOXML formats are ZIP archives
+        if not header.startswith((b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'PK\x03\x04')):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid Office document"
+            )
     
     def _generate_secure_filename(self, original_name: str) -> str:
         """Generate secure filename to prevent path traversal"""
@@ -224,42 +362,160 @@ class FileService:
         safe_name = SecurityUtils.sanitize_filename(basename)
         
         # Add timestamp and random string
-        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
         random_str = uuid.uuid4().hex[:8]
         
         return f"{timestamp}_{random_str}_{safe_name}"
     
-    async def _calculate_file_hash(self, file: UploadFile) -> str:
-        """Calculate SHA-256 hash of file"""
-        sha256 = hashlib.sha256()
+    def _calculate_quick_hash(self, file: UploadFile) -> str:
+        """Cheap fingerprint of file size and first 4KB used to rule out duplicates (blocking)"""
+        src = file.file
+        src.seek(0, 2)
+        file_size = src.tell()
+        src.seek(0)
+        header = src.read(HEADER_SIZE)
+        src.seek(0)
+        
+        return hashlib.blake2b(header + file_size.to_bytes(8, 'big'), digest_size=16).hexdigest()
+    
+    async def _encrypt_and_save(self, file: UploadFile, file_id: str, quick_hash: str) -> Tuple[str, str, int, str]:
+        """Validate, encrypt and save file securely, returning its path, SHA-256 hash, size and wrapped key"""
+        # Generate file path inside the pre-created shard tree
+        file_path = f"{self.encrypted_dir}/{file_id[:2]}/{file_id[2:4]}/{file_id}.enc"
+        
+        # Possible duplicate: validate and hash without encrypting, then link
+        # the stored ciphertext (sharing its wrapped key) if the content matches
+        checked = None
+        if await self._has_quick_hash(quick_hash):
+            checked = await asyncio.to_thread(self._process_upload, file)
+            file_hash, file_size = checked
+            duplicate = await self._find_by_hash(file_hash)
+            if duplicate:
+                try:
+                    await asyncio.to_thread(
+                        self._create_in_shard,
+                        lambda path: os.link(duplicate['encrypted_path'], path),
+                        file_path
+                    )
+                    return file_path, file_hash, file_size, duplicate['encryption_key_encrypted']
+                except FileNotFoundError:
+                    # Original expired or was deleted since the lookup: store a fresh copy
+                    pass
+        
+        # Fresh random data key per file, persisted only wrapped under the master key
+        data_key = os.urandom(DATA_KEY_SIZE)
+        wrapped_key = aes_key_wrap(self.key_encryption_key, data_key).hex()
+        
+        # Set if this request is cancelled (client disconnect): the worker
+        # thread is not interrupted, so it polls this and stops by itself
+        abort = threading.Event()
+        try:
+            # Run the whole read/encrypt/write loop in one worker thread
+            # (it removes its own partial file when the upload is rejected)
+            file_hash, file_size = await asyncio.to_thread(
+                self._write_encrypted, file, file_path, data_key, checked, abort
+            )
+        except BaseException:
+            # Never leave a partially written file behind: stop the worker and
+            # remove the file in case it had already passed its last check
+            abort.set()
+            await asyncio.to_thread(self._remove_partial_file, file_path)
+            raise
+        
+        return file_path, file_hash, file_size, wrapped_key
+    
+    def _process_upload(self, file: UploadFile, consume: Optional[Callable[[bytes], None]] = None) -> Tuple[str, int]:
+        """Validate, scan and hash the upload, passing each chunk to consume (blocking)"""
+        sha256 = hashlib.new('sha256', usedforsecurity=True)
         
-        # Read file in chunks
-        chunk_size = 8192
-        while chunk := await file.read(chunk_size):
-            sha256.update(chunk)
+        # Read the upload exactly once: validate, scan and hash each chunk
+        chunk_size = 1 << 20  # 1MB chunks
+        file_size = 0
+        scan_tail = b''
+        pending_scans = deque()
         
-        await file.seek(0)
-        return sha256.hexdigest()
-    
-    async def _encrypt_and_save(self, file: UploadFile, file_id: str) -> str:
-        """Encrypt and save file securely"""
-        # Create secure directory
-        secure_dir = os.path.join(self.temp_dir, 'encrypted', file_id[:2], file_id[2:4])
-        os.makedirs(secure_dir, exist_ok=True)
+        src = file.file
+        src.seek(0)
         
-        # Generate file path
-        file_path = os.path.join(secure_dir, f"{file_id}.enc")
+        chunk = src.read(chunk_size)
+        self._validate_file_type(file, chunk)
+        self._validate_file_content(file, chunk[:HEADER_SIZE])
+        
+        try:
+            while chunk:
+                file_size += len(chunk)
+                self._validate_file_size(file_size)
+                
+                scan, scanned, scan_tail = self._scan_for_malware(chunk, scan_tail)
+                pending_scans.append((scan, scanned))
+                
+                # Fail fast on finished scans and cap chunks held in flight
+                while pending_scans and (pending_scans[0][0].done() or len(pending_scans) > MAX_PENDING_SCANS):
+                    self._check_malware_scan(*pending_scans.popleft())
+                
+                sha256.update(chunk)
+                if consume:
+                    consume(chunk)
+                
+                chunk = src.read(chunk_size)
+            
+            while pending_scans:
+                self._check_malware_scan(*pending_scans.popleft())
+        finally:
+            for scan, _ in pending_scans:
+                scan.cancel()
         
-        # Read and encrypt file in chunks
-        chunk_size = 64 * 1024  # 64KB chunks
+        return sha256.hexdigest(), file_size
+    
+    def _write_encrypted(self, file: UploadFile, file_path: str, data_key: bytes, checked: Optional[Tuple[str, int]] = None, abort: Optional[threading.Event] = None) -> Tuple[str, int]:
+        """Validate, scan, hash and encrypt the upload into file_path, removing it on failure (blocking)"""
+        # Single AES-256-GCM stream: encryption and authentication in one pass
+        nonce = os.urandom(NONCE_SIZE)
+        encryptor = Cipher(algorithms.AES(data_key), modes.GCM(nonce)).encryptor()
+        
+        # Owner-only, never reuse an existing path
+        fd = self._create_in_shard(
+            lambda path: os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600),
+            file_path
+        )
         
-        async with aiofiles.open(file_path, 'wb') as f:
-            while chunk := await file.read(chunk_size):
-                encrypted_chunk = self.cipher.encrypt(chunk)
-                await f.write(encrypted_chunk)
+        try:
+            with open(fd, 'wb', buffering=1 << 20) as f:
+                f.write(nonce)
+                
+                def encrypt_chunk(chunk: bytes):
+                    if abort and abort.is_set():
+                        raise CancelledError("Upload cancelled")
+                    f.write(encryptor.update(chunk))
+                
+                if checked:
+                    # Already validated, scanned and hashed by the duplicate check
+                    file_hash, file_size = checked
+                    src = file.file
+                    src.seek(0)
+                    chunk_size = 1 << 20  # 1MB chunks
+                    while chunk := src.read(chunk_size):
+                        encrypt_chunk(chunk)
+                else:
+                    file_hash, file_size = self._process_upload(file, encrypt_chunk)
+                
+                f.write(encryptor.finalize())
+                f.write(encryptor.tag)
+            
+            if abort and abort.is_set():
+                raise CancelledError("Upload cancelled")
+        except BaseException:
+            self._remove_partial_file(file_path)
+            raise
         
-        await file.seek(0)
-        return file_path
+        return file_hash, file_size
+    
+    def _remove_partial_file(self, file_path: str):
+        """Remove a partially written upload if it exists (blocking)"""
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
     
     async def decrypt_and_read(self, file_id: str) -> bytes:
         """Decrypt and read file"""
@@ -273,22 +529,43 @@ class FileService:
             )
         
         # Check if file has expired
-        if datetime.utcnow() > metadata['expires_at']:
+        if datetime.now(timezone.utc) > metadata['expires_at']:
             await self.delete_file(file_id)
             raise HTTPException(
                 status_code=status.HTTP_410_GONE,
                 detail="File has expired and been deleted"
             )
         
+        # Unwrap the per-file data key
+        try:
+            data_key = aes_key_unwrap(
+                self.key_encryption_key,
+                bytes.fromhex(metadata['encryption_key_encrypted'])
+            )
+        except (InvalidUnwrap, ValueError):
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to decrypt file"
+            )
+        
         # Decrypt file
         encrypted_path = metadata['encrypted_path']
         
         async with aiofiles.open(encrypted_path, 'rb') as f:
             encrypted_data = await f.read()
         
+        if len(encrypted_data) < NONCE_SIZE + TAG_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to decrypt file"
+            )
+        
+        nonce = encrypted_data[:NONCE_SIZE]
+        
+        # Decrypt and verify the GCM tag (appended to the ciphertext) in one call
         try:
-            decrypted_data = self.cipher.decrypt(encrypted_data)
-        except Exception as e:
+            decrypted_data = AESGCM(data_key).decrypt(nonce, encrypted_data[NONCE_SIZE:], None)
+        except InvalidTag:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Failed to decrypt file"
@@ -304,61 +581,62 @@ class FileService:
         if not metadata:
             return False
         
-        # Securely wipe file
-        encrypted_path = metadata['encrypted_path']
-        
-        if os.path.exists(encrypted_path):
-            # Overwrite with random data before deletion
-            await self._secure_wipe(encrypted_path)
-            
-            # Delete file
-            os.remove(encrypted_path)
-            
-            # Remove directory if empty
-            try:
-                os.removedirs(os.path.dirname(encrypted_path))
-            except OSError:
-                pass
+        # Securely wipe and delete file (shard directories are kept for reuse)
+        await self._secure_wipe(metadata['encrypted_path'])
         
-        # Delete metadata
+        # Delete metadata (discards the wrapped data key, crypto-shredding the file)
         await self._delete_metadata(file_id)
         
         return True
     
     async def _secure_wipe(self, file_path: str):
-        """Securely wipe file by overwriting with random data"""
-        file_size = os.path.getsize(file_path)
-        
-        # Overwrite 3 times (DoD 5220.22-M standard)
-        for _ in range(3):
-            random_data = os.urandom(file_size)
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(random_data)
+        """Securely wipe file by unlinking it, then truncating it to release its blocks once no other link remains"""
+        # Overwriting in place does not reach the original blocks on SSD or
+        # copy-on-write filesystems. Confidentiality comes from the per-file
+        # data key being discarded with the metadata; here we only free the
+        # ciphertext blocks in O(1) syscalls.
+        await asyncio.to_thread(self._remove_and_truncate, file_path)
+    
+    def _remove_and_truncate(self, file_path: str):
+        """Unlink file, truncating it only if no deduplicated upload still links to it (blocking)"""
+        try:
+            fd = os.open(file_path, os.O_WRONLY)
+        except FileNotFoundError:
+            return
+        
+        try:
+            os.remove(file_path)
+            
+            # Link count is read after unlinking, so no upload can link the
+            # path between this check and the truncate
+            if os.fstat(fd).st_nlink == 0:
+                os.ftruncate(fd, 0)
+                os.fsync(fd)
+        except FileNotFoundError:
+            # Already removed by a concurrent delete
+            pass
+        finally:
+            os.close(fd)
     
     def _is_valid_extension(self, extension: str, mime_type: str) -> bool:
         """Check if extension matches MIME type"""
-        extension_map = {
-            'pdf': 'application/pdf',
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg',
-            'png': 'image/png',
-            'gif': 'image/gif',
-            'svg': 'image/svg+xml',
-            'doc': 'application/msword',
-            'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'xls': 'application/vnd.ms-excel',
-            'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'ppt': 'application/vnd.ms-powerpoint',
-            'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
-        }
-        
-        return extension_map.get(extension) == mime_type
+        return EXTENSION_MIME_TYPES.get(extension) == mime_type
     
     async def _store_metadata(self, metadata: Dict[str, Any]):
         """Store file metadata (simplified - implement with database)"""
         # In production, store in PostgreSQL/Redis
         pass
     
+    async def _has_quick_hash(self, quick_hash: str) -> bool:
+        """Check whether any stored file shares this quick hash (simplified - implement with database)"""
+        # In production, look up by the indexed quick_hash column
+        return False
+    
+    async def _find_by_hash(self, file_hash: str) -> Optional[Dict[str, Any]]:
+        """Get metadata of a stored file with this SHA-256 (simplified - implement with database)"""
+        # In production, look up by the indexed hash column
+        pass
+    
     async def _get_metadata(self, file_id: str) -> Optional[Dict[str, Any]]:
         """Get file metadata (simplified - implement with database)"""
         # In production, retrieve from database
@@ -368,3 +646,6 @@ class FileService:
         """Delete file metadata (simplified - implement with database)"""
         # In production, delete from database
         pass
+
+# Shared instance so key derivation and setup run once per process
+file_service = FileService()
@@ -0,0 +1,115 @@
+"""
+Batched background log writer
+
+Each LogBatcher starts its consumer on first write. The app's shutdown hook
+must `await <batcher>.stop()` for every instance (security_log in
+security.py, incident_log in incident_response.py) so queued lines are
+flushed before the process exits.
+"""
+
+import os
+import asyncio
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# Queued after all pending lines to make the consumer flush and exit
+_STOP = object()
+
+class LogBatcher:
+    """Coalesce log lines into large appends written from a background task"""
+    
+    def __init__(self, path: str, max_batch: int = 512, flush_ms: int = 200, max_queue: int = 10000):
+        self.path = path
+        self.max_batch = max_batch
+        self.flush_interval = flush_ms / 1000
+        self.max_queue = max_queue
+        self.queue = None
+        self.dropped = 0
+        self._loop = None
+        self._task = None
+    
+    def start(self):
+        """Start the background consumer (call on app startup)"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            # Queues bind to the loop that first uses them, so each consumer
+            # gets a fresh one (test clients run every request on a new loop)
+            self._loop = loop
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = loop.create_task(self._consume())
+    
+    def write(self, line: str):
+        """Queue a line for writing without blocking the caller"""
+        self.start()
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            # Never stall the request path on logging; drop under overload
+            # and report how many lines were lost on the next flush
+            self.dropped += 1
+    
+    async def stop(self):
+        """Flush every queued line and stop the consumer (call on app shutdown)"""
+        if self._task is None or self._task.done() or self._loop is not asyncio.get_running_loop():
+            self._task = None
+            return
+        
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
+    
+    async def _consume(self):
+        """Collect up to max_batch lines or flush_ms worth, then write them at once"""
+        loop = asyncio.get_running_loop()
+        buf = []
+        
+        while True:
+            item = await self.queue.get()
+            stopping = item is _STOP
+            if not stopping:
+                buf.append(item)
+            
+            deadline = loop.time() + self.flush_interval
+            while not stopping and len(buf) < self.max_batch:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                
+                if item is _STOP:
+                    stopping = True
+                else:
+                    buf.append(item)
+            
+            if self.dropped:
+                logger.warning("Log queue full: dropped %d lines for %s", self.dropped, self.path)
+                self.dropped = 0
+            
+            if buf:
+                try:
+                    await asyncio.to_thread(self._write_buf, buf)
+                except Exception:
+                    # Keep consuming: one failed write (EACCES, ENOSPC, missing
+                    # mount) must not stop logging for the rest of the process
+                    logger.exception("Failed to write %d log lines to %s", len(buf), self.path)
+                buf = []
+            
+            if stopping:
+                return
+    
+    def _write_buf(self, lines: List[str]):
+        """Append lines to the log file in a single write (blocking)"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        with open(self.path, 'a') as f:
+            f.write(''.join(lines))
@@ -2,14 +2,81 @@
 Security middleware for the API
 """
 
+import copy
 import time
-from typing import Optional
-from fastapi import Request, HTTPException
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from fastapi import Request, HTTPException, status
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
+from starlette.responses import JSONResponse, Response
+from starlette.types import Message
 import jwt
+import orjson
 from src.core.config import settings
 from src.core.security import SecurityUtils
+from src.utils.log_batcher import LogBatcher
+
+logger = logging.getLogger("security")
+
+# Per-request access log, flushed in batches by a background task
+# (await security_log.stop() from the app's shutdown hook)
+security_log = LogBatcher('logs/security.log')
+
+# Built once at import; applied to every response
+SECURITY_HEADERS = (
+    ("X-Frame-Options", "DENY"),
+    ("X-Content-Type-Options", "nosniff"),
+    ("X-XSS-Protection", "1; mode=block"),
+    ("Referrer-Policy", "strict-origin-when-cross-origin"),
+    ("Permissions-Policy", "camera=(), microphone=(), geolocation=()"),
+    ("Content-Security-Policy", (
+        "default-src 'self'; "
+        "script-src 'self' 'unsafe-inline' https://cdnjs.cloudflare.com; "
+        "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; "
+        "img-src 'self' data: https:; "
+        "font-src 'self' https://fonts.gstatic.com; "
+        "connect-src 'self'; "
+        "frame-ancestors 'none'; "
+        "form-action 'self'; "
+        "base-uri 'self'"
+    )),
+    ("Strict-Transport-Security", "max-age=31536000; includeSubDomains"),
+    ("Cache-Control", "no-store, max-age=0"),
+    ("Pragma", "no-cache"),
+    ("X-Robots-Tag", "noindex, nofollow")
+)
+
+# Endpoints that skip authentication (tuple so str.startswith checks all at once)
+PUBLIC_PATHS = ("/api/v1/health", "/api/v1/auth/login", "/api/v1/auth/register")
+
+# LRU cache of verified JWT payloads: token digest -> (exp, payload)
+JWT_CACHE_SIZE = 4096
+_jwt_cache: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def _token_cache_key(token: str) -> bytes:
+    """Hash the token so full JWTs are not pinned in memory"""
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def invalidate_token(token: str):
+    """Drop a token from the JWT cache (call on logout/revocation)"""
+    _jwt_cache.pop(_token_cache_key(token), None)
+
+def _replay_body(request: Request, body: bytes) -> Request:
+    """Copy of request whose receive() yields the already-read body first"""
+    # Starlette < 0.28 does not pass a body read in BaseHTTPMiddleware on to
+    # the app, so the handler would wait for a body that never arrives
+    body_sent = False
+    
+    async def receive() -> Message:
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await request.receive()
+    
+    return Request(request.scope, receive)
 
 class SecurityMiddleware(BaseHTTPMiddleware):
     """Enhanced security middleware"""
@@ -18,54 +85,41 @@ class SecurityMiddleware(BaseHTTPMiddleware):
         # Start timing
         start_time = time.time()
         
-        # Security headers
-        response = await self.add_security_headers(request, call_next)
-        
-        # Log request
-        await self.log_request(request, response, start_time)
-        
-        # Rate limiting check
+        # Rate limiting check (before the handler, so rejected requests cost nothing)
         await self.check_rate_limit(request)
         
-        # Input sanitization
-        await self.sanitize_inputs(request)
+        # Input sanitization, then run the handler
+        try:
+            body = await self.sanitize_inputs(request)
+        except orjson.JSONDecodeError:
+            # Malformed JSON, including NaN/Infinity, which orjson rejects
+            # but request.json() accepted. (Integers wider than 64 bits are
+            # parsed as floats and lose precision.)
+            response = JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={"detail": "Invalid JSON body"}
+            )
+        else:
+            if body is not None:
+                request = _replay_body(request, body)
+            response = await call_next(request)
+        
+        # Security headers
+        self.add_security_headers(response)
         
         # XSS protection
         await self.prevent_xss(request, response)
         
+        # Log request
+        self.log_request(request, response, start_time)
+        
         return response
     
-    async def add_security_headers(self, request: Request, call_next):
+    def add_security_headers(self, response: Response):
         """Add security headers to response"""
-        response = await call_next(request)
-        
-        headers = {
-            "X-Frame-Options": "DENY",
-            "X-Content-Type-Options": "nosniff",
-            "X-XSS-Protection": "1; mode=block",
-            "Referrer-Policy": "strict-origin-when-cross-origin",
-            "Permissions-Policy": "camera=(), microphone=(), geolocation=()",
-            "Content-Security-Policy": (
-                "default-src 'self'; "
-                "script-src 'self' 'unsafe-inline' https://cdnjs.cloudflare.com; "
-                "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; "
-                "img-src 'self' data: https:; "
-                "font-src 'self' https://fonts.gstatic.com; "
-                "connect-src 'self'; "
-                "frame-ancestors 'none'; "
-                "form-action 'self'; "
-                "base-uri 'self'"
-            ),
-            "Strict-Transport-Security": "max-age=31536000; includeSubDomains",
-            "Cache-Control": "no-store, max-age=0",
-            "Pragma": "no-cache",
-            "X-Robots-Tag": "noindex, nofollow"
-        }
-        
-        for header, value in headers.items():
-            response.headers[header] = value
-        
-        return response
+        headers = response.headers
+        for header, value in SECURITY_HEADERS:
+            headers[header] = value
     
     async def check_rate_limit(self, request: Request):
         """Check rate limit for IP"""
@@ -75,22 +129,31 @@ class SecurityMiddleware(BaseHTTPMiddleware):
         # This is a simplified version - use Redis in production
         pass
     
-    async def sanitize_inputs(self, request: Request):
-        """Sanitize all incoming data"""
+    async def sanitize_inputs(self, request: Request) -> Optional[bytes]:
+        """Sanitize all incoming data, returning the raw body if it was read"""
         if request.method in ["POST", "PUT", "PATCH"]:
             # Check content type
             content_type = request.headers.get("content-type", "")
             if "application/json" in content_type:
-                body = await request.json()
+                # Parse once with orjson and share the result with the handler
+                raw_body = await request.body()
+                body = orjson.loads(raw_body)
+                request.state.parsed_body = body
                 sanitized = SecurityUtils.sanitize_json(body)
                 request.state.sanitized_body = sanitized
+                return raw_body
             elif "multipart/form-data" in content_type:
                 # File uploads are handled separately
                 pass
             elif "application/x-www-form-urlencoded" in content_type:
+                # Read the body first so form parsing uses the cached copy
+                raw_body = await request.body()
                 form_data = await request.form()
                 sanitized = SecurityUtils.sanitize_dict(dict(form_data))
                 request.state.sanitized_body = sanitized
+                return raw_body
+        
+        return None
     
     async def prevent_xss(self, request: Request, response: Response):
         """Prevent XSS attacks"""
@@ -99,8 +162,8 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             # Add XSS protection headers
             pass
     
-    async def log_request(self, request: Request, response: Response, start_time: float):
-        """Log request details for security monitoring"""
+    def log_request(self, request: Request, response: Response, start_time: float):
+        """Log request details for security monitoring (only queues, never blocks)"""
         duration = time.time() - start_time
         
         log_data = {
@@ -115,10 +178,8 @@ class SecurityMiddleware(BaseHTTPMiddleware):
             "content_length": response.headers.get("content-length", 0)
         }
         
-        # Log to file/database
-        import logging
-        logger = logging.getLogger("security")
-        logger.info(f"Request: {log_data}")
+        # Log to file (queued, written in batches off the request path)
+        security_log.write(orjson.dumps(log_data).decode() + "\n")
         
         # Alert on suspicious activity
         if duration > 10:  # Request took more than 10 seconds
@@ -132,9 +193,7 @@ class AuthenticationMiddleware(BaseHTTPMiddleware):
     
     async def dispatch(self, request: Request, call_next):
         # Skip authentication for public endpoints
-        public_paths = ["/api/v1/health", "/api/v1/auth/login", "/api/v1/auth/register"]
-        
-        if any(request.url.path.startswith(path) for path in public_paths):
+        if request.url.path.startswith(PUBLIC_PATHS):
             return await call_next(request)
         
         # Get token from header
@@ -147,26 +206,41 @@ class AuthenticationMiddleware(BaseHTTPMiddleware):
         
         token = auth_header.split(" ")[1]
         
-        try:
-            # Verify token
-            payload = jwt.decode(
-                token,
-                settings.JWT_SECRET,
-                algorithms=[settings.JWT_ALGORITHM]
-            )
-            
-            # Add user to request state
-            request.state.user = payload
+        # Reuse the payload of a token already verified and not yet expired
+        cache_key = _token_cache_key(token)
+        entry = _jwt_cache.get(cache_key)
+        if entry and entry[0] > time.time():
+            _jwt_cache.move_to_end(cache_key)
+            # Handlers get their own copy so they cannot alter the cached entry
+            payload = copy.deepcopy(entry[1])
+        else:
+            try:
+                # Verify token
+                payload = jwt.decode(
+                    token,
+                    settings.JWT_SECRET,
+                    algorithms=[settings.JWT_ALGORITHM]
+                )
+            except jwt.ExpiredSignatureError:
+                _jwt_cache.pop(cache_key, None)
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Token has expired"
+                )
+            except jwt.InvalidTokenError:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Invalid token"
+                )
             
-        except jwt.ExpiredSignatureError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token has expired"
-            )
-        except jwt.InvalidTokenError:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token"
-            )
+            # Only tokens with an expiry are cached, and only until they expire
+            if "exp" in payload:
+                _jwt_cache[cache_key] = (int(payload["exp"]), copy.deepcopy(payload))
+                _jwt_cache.move_to_end(cache_key)
+                if len(_jwt_cache) > JWT_CACHE_SIZE:
+                    _jwt_cache.popitem(last=False)
+        
+        # Add user to request state
+        request.state.user = payload
         
         return await call_next(request)